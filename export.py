@@ -13,6 +13,9 @@ import os
 import json
 import math
 import shutil
+import hashlib
+import array
+import time
 from bpy_extras.io_utils import ExportHelper
 from bpy.props import StringProperty
 from bpy.types import Operator
@@ -35,6 +38,32 @@ bl_info = {  # pylint: disable=invalid-name
 
 PRETTY_JSON = False  # Make JSON human readable, takes more disk space
 
+# Pack the images of materials that only differ by their textures into shared
+# atlas pages so that they can be merged into a single material
+ATLAS_TEXTURES = False
+ATLAS_SIZE = 2048  # Maximum width and height of an atlas page in pixels
+# Number of mip levels kept free of bleeding between neighbouring images. At
+# mip level n one texel covers 2**n pixels, so every image's cell starts on a
+# multiple of 2**n pixels and has a gutter (filled with the image's edge
+# pixels) one level n texel wide
+ATLAS_MIP_LEVELS = 4
+ATLAS_ALIGN = 2 ** ATLAS_MIP_LEVELS
+ATLAS_PADDING = 2 ** ATLAS_MIP_LEVELS
+ATLAS_CACHE_DIR = os.path.join(
+    os.path.expanduser('~'), '.cache', 'playcanvas-atlas'
+)
+
+# Merge mesh datablocks with identical geometry, UVs, colours and materials
+# (eg from Shift+D duplicates) into one exported mesh with many instances
+DEDUPLICATE_MESHES = True
+
+# Split meshes with more than CHUNK_TRIANGLES triangles into spatial chunks,
+# each of which becomes it's own mesh that playcanvas can cull
+CHUNK_MESHES = False
+CHUNK_TRIANGLES = 20000  # Triangle budget for each chunk
+CHUNK_MODE = 'OCTREE'  # 'OCTREE' or 'GRID'
+CHUNK_ORIGIN = (0, 0, 0)  # Chunk manifest is ordered by distance from here
+
 # ------ END CONFIGURATION -----
 
 
@@ -119,10 +148,23 @@ class HeirachyExporter(object):
         self.mesh_list = self.generate_mesh_list()
         mesh_data_list = list()
         for mesh_id, mesh in enumerate(self.mesh_list):
+            start = time.time()
             mesh_data_list.append(MeshParser(mesh, mesh_id, self.uv_list))
+            self.mesh_stats[mesh_id]['time'] += time.time() - start
+
+        if self.merged_count:
+            self.report_duplicates(mesh_data_list)
 
         node_data, parents = self.generate_node_data()
 
+        self.atlas = None
+        if ATLAS_TEXTURES:
+            info("Packing Texture Atlases ...")
+            self.atlas = TextureAtlas(
+                self.heirachy.name, self.mesh_list, mesh_data_list,
+                self.uv_list, path_data
+            )
+
         info("Exporting Mappings ...")
         material_list = self.export_mappings(path_data)
 
@@ -130,6 +172,10 @@ class HeirachyExporter(object):
         for mat in material_list:
             MaterialExporter(mat, self.uv_list, path_data)
 
+        if self.chunk_ids:
+            info("Exporting Chunk Manifest ...")
+            self.export_chunk_manifest(mesh_data_list, path_data)
+
         info("Exporting Main file")
         output = {
             'model': {
@@ -190,28 +236,91 @@ class HeirachyExporter(object):
         mesh_contents.to_mesh(EMPTY_MESH)
 
         raw_meshes = dict()
+        datablocks = dict()  # The datablock names that share each key
+        fingerprints = dict()
+        self.fingerprint_time = 0.0
         for obj in self.heirachy.objects:
             # We want to build a dict of:
-            # {'mesh_name', [instance1, instance2 ...], 'mesh_name2'[...])
+            # {'mesh_key', [instance1, instance2 ...], 'mesh_key2'[...])
+            # Where the key is the mesh name, or a hash of it's contents
+            # if duplicate meshes are being merged
             if obj.type == 'MESH':
                 data = obj.data
             else:
                 data = EMPTY_MESH
 
-            if data.name not in raw_meshes:
-                raw_meshes[data.name] = [obj]
+            key = data.name
+            if DEDUPLICATE_MESHES and obj.type == 'MESH':
+                if data.name not in fingerprints:
+                    start = time.time()
+                    fingerprints[data.name] = mesh_fingerprint(data)
+                    self.fingerprint_time += time.time() - start
+                key = fingerprints[data.name]
+
+            if key not in raw_meshes:
+                raw_meshes[key] = [obj]
+                datablocks[key] = [data.name]
             else:
-                raw_meshes[data.name].append(obj)
+                raw_meshes[key].append(obj)
+                if data.name not in datablocks[key]:
+                    datablocks[key].append(data.name)
 
         mesh_list = list()
-        for mesh_name in raw_meshes:
+        self.chunk_ids = set()  # Indices of meshes that are spatial chunks
+        # How many datablocks were merged into another one
+        self.merged_count = sum(
+            len(names) - 1 for names in datablocks.values()
+        )
+        # For each split mesh, how many datablocks were merged into the one it
+        # came from and how long it took to export
+        self.mesh_stats = list()
+        for key in raw_meshes:
             # Split the meshes by material and convert them to bmesh
-            mesh = bpy.data.meshes[mesh_name]
-            meshes = separate_mesh_by_material(mesh, raw_meshes[mesh_name])
+            start = time.time()
+            mesh = bpy.data.meshes[datablocks[key][0]]
+            meshes = separate_mesh_by_material(mesh, raw_meshes[key])
+            if CHUNK_MESHES:
+                chunked_meshes = list()
+                for single_mesh in meshes:
+                    chunks = chunk_mesh(single_mesh)
+                    if len(chunks) > 1:
+                        first_id = len(mesh_list) + len(chunked_meshes)
+                        self.chunk_ids.update(
+                            range(first_id, first_id + len(chunks))
+                        )
+                    chunked_meshes += chunks
+                meshes = chunked_meshes
             mesh_list += meshes
 
+            split_time = (time.time() - start) / max(len(meshes), 1)
+            for _mesh in meshes:
+                self.mesh_stats.append({
+                    'duplicates': len(datablocks[key]) - 1,
+                    'time': split_time,
+                })
+
         return mesh_list
 
+    def report_duplicates(self, mesh_data_list):
+        '''Reports how much merging duplicate mesh datablocks saved, assuming
+        each duplicate would have been as big and as slow as the one that was
+        exported. The time spent fingerprinting every datablock is taken off
+        the time saved'''
+        bytes_saved = 0
+        time_saved = 0.0
+        for mesh_data, stats in zip(mesh_data_list, self.mesh_stats):
+            if not stats['duplicates']:
+                continue
+            bytes_saved += estimate_json_size(mesh_data) * stats['duplicates']
+            time_saved += stats['time'] * stats['duplicates']
+        time_saved -= self.fingerprint_time
+
+        report("Merged {} duplicate meshes in {}, saving {} bytes and "
+               "{:.2f}s (net of {:.2f}s spent fingerprinting)".format(
+                   self.merged_count, self.heirachy.name,
+                   bytes_saved, time_saved, self.fingerprint_time
+               ))
+
     def export_mappings(self, path_data):
         '''Exports the mapping between meshes and materials'''
         output = {'mapping': list()}
@@ -231,14 +340,16 @@ class HeirachyExporter(object):
             path_data['mesh']
         )
         for mesh_map in mapping_list:
-            for face in mesh_map[1].faces:
-                mat_id = face.material_index
-                break
-
-            data = mesh_map[2][0].data
-            if hasattr(data, 'materials') and data.materials:
+            mat = mesh_material(mesh_map)
+            if mat is not None and self.atlas is not None and \
+                    mat.name in self.atlas.remap:
+                # The material has been merged into an atlas material, which
+                # the atlas has already exported
+                new_mat_path = os.path.join(
+                    mesh_to_material_path, self.atlas.remap[mat.name]+'.json'
+                )
+            elif mat is not None:
                 # If there is a material in the mesh, export it's path
-                mat = data.materials[mat_id]
                 new_mat_path = os.path.join(
                     mesh_to_material_path, mat.name+'.json'
                 )
@@ -283,21 +394,12 @@ class HeirachyExporter(object):
         node_data = list()
         for mesh in self.mesh_list:
             for instance in mesh[2]:
-                if instance.parent is not None:
-                    transform = instance.matrix_local
-                    position = transform.translation
-                    corrected_rotation = mathutils.Vector(transform.to_euler())
-                    corrected_rotation *= 180 / math.pi
-                    scale = transform.to_scale()
-                else:
-                    position = [0, 0, 0]
-                    corrected_rotation = [0, 0, 0]
-                    scale = [1, 1, 1]
+                position, corrected_rotation, scale = node_transform(instance)
                 node_dict = {
                     'name': instance.name,
-                    'position': list(position),  # Relative to parent
-                    'rotation': list(corrected_rotation),
-                    'scale': list(instance.scale),
+                    'position': position,  # Relative to parent
+                    'rotation': corrected_rotation,
+                    'scale': scale,
                 }
                 node_data.append(node_dict)
 
@@ -314,6 +416,41 @@ class HeirachyExporter(object):
 
         return node_data, parent_list
 
+    def export_chunk_manifest(self, mesh_data_list, path_data):
+        '''Exports a list of the mesh instances that are spatial chunks, nearest
+        to CHUNK_ORIGIN first, so a viewer can stream the closest ones in
+        first. Distances are measured in the space of the exported model'''
+        origin = mathutils.Vector(CHUNK_ORIGIN)
+        exported = set(obj.name for obj in self.heirachy.objects)
+        chunks = list()
+        instance_id = 0
+        for mesh_id, mesh in enumerate(self.mesh_list):
+            for instance in mesh[2]:
+                if mesh_id in self.chunk_ids:
+                    aabb = mesh_data_list[mesh_id]['aabb']
+                    centre = mathutils.Vector([
+                        (low + high) / 2
+                        for low, high in zip(aabb['min'], aabb['max'])
+                    ])
+                    centre = exported_matrix(instance, exported) * centre
+                    chunks.append({
+                        'name': mesh[0],
+                        'meshInstance': instance_id,
+                        'node': instance_id + 1,
+                        'mesh': mesh_id,
+                        'aabb': aabb,
+                        'distance': (centre - origin).length,
+                    })
+                instance_id += 1
+
+        chunks.sort(key=lambda c: (c['distance'], c['meshInstance']))
+        output = {'origin': list(CHUNK_ORIGIN), 'chunks': chunks}
+        file_name = os.path.join(
+            path_data['mesh'],
+            self.heirachy.name + '.chunks.json'
+        )
+        json.dump(output, open(file_name, 'w'), **JSON_PARAMS)
+
     def export_dummy_material(self, name, path_data):
 
         new_mat_path = os.path.join(
@@ -347,8 +484,8 @@ class MeshParser(dict):
 
     def calculate_bounding_box(self):
         '''Get's the mesh extents'''
-        minpos = [float('inf'), float('inf'), float('inf')].copy()
-        maxpos = [float('inf'), float('inf'), float('inf')].copy()
+        minpos = [float('inf'), float('inf'), float('inf')]
+        maxpos = [-float('inf'), -float('inf'), -float('inf')]
         if self.mesh.faces:
             for face in self.mesh.faces:
                 for loop in face.loops:
@@ -356,9 +493,9 @@ class MeshParser(dict):
                     minpos[0] = min(vert.co.x, minpos[0])
                     minpos[1] = min(vert.co.y, minpos[1])
                     minpos[2] = min(vert.co.z, minpos[2])
-                    maxpos[0] = max(vert.co.x, minpos[0])
-                    maxpos[1] = max(vert.co.y, minpos[1])
-                    maxpos[2] = max(vert.co.z, minpos[2])
+                    maxpos[0] = max(vert.co.x, maxpos[0])
+                    maxpos[1] = max(vert.co.y, maxpos[1])
+                    maxpos[2] = max(vert.co.z, maxpos[2])
         else:
             minpos = [0,0,0]
             maxpos = [0,0,0]
@@ -449,6 +586,40 @@ class MeshParser(dict):
         self['count'] = len(self['indices'])
 
 
+def node_transform(instance):
+    '''Returns the position, rotation (in degrees) and scale of an object's
+    node relative to it's parent node. Root objects sit at the origin'''
+    if instance.parent is not None:
+        transform = instance.matrix_local
+        position = transform.translation
+        corrected_rotation = mathutils.Vector(transform.to_euler())
+        corrected_rotation *= 180 / math.pi
+    else:
+        position = [0, 0, 0]
+        corrected_rotation = [0, 0, 0]
+    return list(position), list(corrected_rotation), list(instance.scale)
+
+
+def exported_matrix(instance, exported):
+    '''Returns the transform of an object's node in the exported model, built
+    from the same values that node_transform writes out. exported is the set
+    of object names that have nodes, others are parented to the root node'''
+    position, rotation, scale = node_transform(instance)
+    matrix = mathutils.Matrix.Translation(position)
+    matrix = matrix * mathutils.Euler(
+        [math.radians(angle) for angle in rotation]
+    ).to_matrix().to_4x4()
+    for axis in range(3):
+        scale_matrix = mathutils.Matrix.Scale(
+            scale[axis], 4, [1 if i == axis else 0 for i in range(3)]
+        )
+        matrix = matrix * scale_matrix
+
+    if instance.parent is not None and instance.parent.name in exported:
+        matrix = exported_matrix(instance.parent, exported) * matrix
+    return matrix
+
+
 def separate_mesh_by_material(mesh, obj):
     '''Returns a list of b-mesh meshes separating a mesh by material.
 
@@ -502,6 +673,217 @@ def separate_mesh_by_material(mesh, obj):
     return mesh_list
 
 
+def estimate_json_size(mesh_data):
+    '''Estimates how many bytes a parsed mesh's vertex data and indices take
+    up in the output file by serialising a sample of each array rather than
+    all of it'''
+    arrays = [attr['data'] for attr in mesh_data.vert_data.values()]
+    arrays.append(mesh_data['indices'])
+
+    size = 0
+    for values in arrays:
+        sample = values[::max(1, len(values) // 64)]
+        if sample:
+            sample_size = len(json.dumps(sample, **JSON_PARAMS))
+            size += sample_size * len(values) // len(sample)
+    return size
+
+
+def mesh_fingerprint(mesh):
+    '''Returns a hash of everything about a mesh datablock that ends up in the
+    export: it's geometry, smoothing, UVs, vertex colours and materials.
+    Meshes with the same fingerprint triangulate and export identically'''
+    sha = hashlib.sha1()
+
+    def add(collection, attr, typecode, size=1):
+        '''Hashes an attribute of every item in a collection'''
+        buf = array.array(typecode, [0]) * (len(collection) * size)
+        collection.foreach_get(attr, buf)
+        sha.update(buf.tobytes())
+
+    def add_flags(collection, attr):
+        '''Hashes a boolean attribute of every item in a collection'''
+        buf = [False] * len(collection)
+        collection.foreach_get(attr, buf)
+        sha.update(bytes(bytearray(buf)))
+
+    def add_text(text):
+        '''Hashes a string, terminated so neighbouring strings can't merge'''
+        sha.update(text.encode('utf-8') + b'\0')
+
+    add(mesh.vertices, 'co', 'f', 3)
+    add(mesh.edges, 'vertices', 'i', 2)
+    add_flags(mesh.edges, 'use_edge_sharp')
+    add(mesh.loops, 'vertex_index', 'i')
+    add(mesh.polygons, 'loop_start', 'i')
+    add(mesh.polygons, 'loop_total', 'i')
+    add(mesh.polygons, 'material_index', 'i')
+    add_flags(mesh.polygons, 'use_smooth')
+    add_text(repr((mesh.use_auto_smooth, mesh.auto_smooth_angle)))
+
+    # UV layers are exported by name, so the names matter too
+    for layer in mesh.uv_layers:
+        add_text(layer.name)
+        add(layer.data, 'uv', 'f', 2)
+
+    col_layer = mesh.vertex_colors.active_index
+    if col_layer != -1:
+        add(mesh.vertex_colors[col_layer].data, 'color', 'f', 3)
+
+    for mat in mesh.materials:
+        add_text(mat.name if mat is not None else '')
+
+    if getattr(mesh, 'has_custom_normals', False):
+        # Custom split normals aren't hashed, so don't merge these meshes
+        add_text(mesh.name)
+
+    return sha.hexdigest()
+
+
+def chunk_mesh(mesh):
+    '''Splits a mesh from the mesh list with more than CHUNK_TRIANGLES
+    triangles into spatial chunks, grouping the triangles by their centroids.
+
+    Returned list is in the same form as the mesh list:
+        [('mesh_name.chunk0', bmesh, [instance_list]), ...]
+    '''
+    mesh_name, old_mesh, obj = mesh
+    faces = list(old_mesh.faces)
+    if len(faces) <= CHUNK_TRIANGLES:
+        return [mesh]
+
+    centroids = [face.calc_center_median() for face in faces]
+    face_ids = list(range(len(faces)))
+    if CHUNK_MODE == 'GRID':
+        cells = grid_cells(centroids, face_ids)
+    else:
+        cells = octree_cells(centroids, face_ids)
+
+    chunk_list = list()
+    for chunk_id, cell in enumerate(cells):
+        # Copy just this cell's faces (and their verts and edges) into an
+        # empty bmesh that has the same UV and colour layers
+        cell_faces = [faces[face_id] for face_id in cell]
+        cell_verts = set()
+        cell_edges = set()
+        for face in cell_faces:
+            cell_verts.update(face.verts)
+            cell_edges.update(face.edges)
+        new_mesh = new_bmesh_like(old_mesh)
+        bmesh.ops.duplicate(
+            old_mesh,
+            geom=list(cell_verts) + list(cell_edges) + cell_faces,
+            dest=new_mesh
+        )
+        new_mesh.verts.index_update()
+        chunk_list.append(
+            ('{}.chunk{}'.format(mesh_name, chunk_id), new_mesh, obj)
+        )
+
+    old_mesh.free()
+    return chunk_list
+
+
+def new_bmesh_like(old_mesh):
+    '''Returns an empty bmesh with the same UV and colour layers as another'''
+    new_mesh = bmesh.new()
+    for name in old_mesh.loops.layers.uv.keys():
+        new_mesh.loops.layers.uv.new(name)
+    for name in old_mesh.loops.layers.color.keys():
+        new_mesh.loops.layers.color.new(name)
+    # Blender versions before 2.8 also keep face texture layers alongside UVs
+    if hasattr(old_mesh.faces.layers, 'tex'):
+        for name in old_mesh.faces.layers.tex.keys():
+            if name not in new_mesh.faces.layers.tex.keys():
+                new_mesh.faces.layers.tex.new(name)
+    return new_mesh
+
+
+def octree_cells(centroids, face_ids):
+    '''Recursively splits a list of faces into octants until each has at most
+    CHUNK_TRIANGLES faces. Returns a list of lists of face ids'''
+    if len(face_ids) <= CHUNK_TRIANGLES:
+        return [face_ids]
+
+    minpos = [min(centroids[i][axis] for i in face_ids) for axis in range(3)]
+    maxpos = [max(centroids[i][axis] for i in face_ids) for axis in range(3)]
+    centre = [(low + high) / 2 for low, high in zip(minpos, maxpos)]
+
+    # Only split the axes that are at least half as long as the longest one,
+    # so that flat meshes such as terrain are split as a quadtree
+    extents = [high - low for low, high in zip(minpos, maxpos)]
+    axes = [axis for axis in range(3) if extents[axis] * 2 >= max(extents)]
+
+    octants = dict()
+    for face_id in face_ids:
+        point = centroids[face_id]
+        key = tuple(point[axis] > centre[axis] for axis in axes)
+        octants.setdefault(key, []).append(face_id)
+
+    if len(octants) == 1:
+        # Every centroid is in the same place, so it can't be split further
+        return [face_ids]
+
+    cells = list()
+    for key in sorted(octants):
+        cells += octree_cells(centroids, octants[key])
+    return cells
+
+
+def grid_cells(centroids, face_ids):
+    '''Splits a list of faces into a uniform grid of roughly square cells,
+    using no more cells than are needed to hold CHUNK_TRIANGLES faces each if
+    they were evenly spread. Cells that end up over budget are split further
+    as an octree. Returns a list of lists of face ids'''
+    minpos = [min(c[axis] for c in centroids) for axis in range(3)]
+    maxpos = [max(c[axis] for c in centroids) for axis in range(3)]
+    extents = [high - low for low, high in zip(minpos, maxpos)]
+    num_cells = math.ceil(len(face_ids) / CHUNK_TRIANGLES)
+
+    # Axes shorter than a cell aren't divided, so flat meshes such as terrain
+    # are only divided along their spread axes
+    axes = [axis for axis in range(3) if extents[axis] > 0]
+    while axes:
+        volume = 1.0
+        for axis in axes:
+            volume *= extents[axis]
+        cell_size = (volume / num_cells) ** (1.0 / len(axes))
+        short_axes = [axis for axis in axes if extents[axis] < cell_size]
+        if not short_axes:
+            break
+        axes = [axis for axis in axes if axis not in short_axes]
+    if not axes:
+        return octree_cells(centroids, face_ids)
+
+    divisions = [1, 1, 1]
+    for axis in axes:
+        divisions[axis] = max(1, int(round(extents[axis] / cell_size)))
+    # Rounding up may have overshot, keep the grid to num_cells cells
+    while divisions[0] * divisions[1] * divisions[2] > num_cells:
+        # Take a division from the axis with the thinnest cells
+        axis = min(
+            [a for a in axes if divisions[a] > 1],
+            key=lambda a: extents[a] / divisions[a]
+        )
+        divisions[axis] -= 1
+
+    grid = dict()
+    for face_id in face_ids:
+        point = centroids[face_id]
+        key = tuple(
+            min(int((point[axis] - minpos[axis]) / extents[axis] *
+                    divisions[axis]), divisions[axis] - 1)
+            if divisions[axis] > 1 else 0
+            for axis in range(3)
+        )
+        grid.setdefault(key, []).append(face_id)
+
+    cells = list()
+    for key in sorted(grid):
+        cells += octree_cells(centroids, grid[key])
+    return cells
+
+
 class MaterialExporter(dict):
     '''Exports a single material'''
     def __init__(self, material, uv_list, path_data):
@@ -517,40 +899,13 @@ class MaterialExporter(dict):
 
     def _parse_basic_properties(self):
         '''Basic Material Properties such as diffuse color'''
-        mat = self.material
-        spec_color = mat.specular_color * mat.specular_intensity
-        emit_color = mat.diffuse_color * mat.emit
-
-        self['diffuse'] = list(mat.diffuse_color)
-        self['specular'] = list(spec_color)
-        self['emissive'] = list(emit_color)
-
-        if mat.game_settings.alpha_blend == 'ADD':
-            self["blendType"] = 1
-
-        if mat.use_vertex_color_paint:
-            self['diffuseMapVertexColor'] = True
-        if mat.use_vertex_color_light:
-            self['emissiveMapVertexColor'] = True
-
-        if mat.alpha != 1.0:
-            self['opacity'] = mat.alpha
-
-        if not mat.game_settings.use_backface_culling:
-            self['cull'] = 0
+        self.update(parse_basic_properties(self.material))
 
     def _parse_images(self, path_data):
         '''Look through textures for image paths'''
         path_to_image_dir = os.path.relpath(path_data['img'], path_data['mat'])
 
-        for tex_id, tex in enumerate(self.material.texture_slots):
-            if tex is None or tex.texture.type != 'IMAGE':
-                # Ignore empty texture slots or ones that aren't images
-                continue
-
-            if not self.material.use_textures[tex_id]:
-                # Ignore texture slots that are disabled
-                continue
+        for tex in image_texture_slots(self.material):
             image_path = copy_image(tex, path_data['img'])
             image_path = os.path.split(image_path)[1]
             image_path = os.path.join(path_to_image_dir, image_path)
@@ -585,11 +940,511 @@ class MaterialExporter(dict):
         json.dump(self, open(file_path, 'w'), **JSON_PARAMS)
 
 
+def parse_basic_properties(mat):
+    '''Returns the basic material properties such as diffuse color'''
+    output = dict()
+    spec_color = mat.specular_color * mat.specular_intensity
+    emit_color = mat.diffuse_color * mat.emit
+
+    output['diffuse'] = list(mat.diffuse_color)
+    output['specular'] = list(spec_color)
+    output['emissive'] = list(emit_color)
+
+    if mat.game_settings.alpha_blend == 'ADD':
+        output["blendType"] = 1
+
+    if mat.use_vertex_color_paint:
+        output['diffuseMapVertexColor'] = True
+    if mat.use_vertex_color_light:
+        output['emissiveMapVertexColor'] = True
+
+    if mat.alpha != 1.0:
+        output['opacity'] = mat.alpha
+
+    if not mat.game_settings.use_backface_culling:
+        output['cull'] = 0
+
+    return output
+
+
+def image_texture_slots(mat):
+    '''Yields the enabled texture slots of a material that contain images'''
+    for tex_id, tex in enumerate(mat.texture_slots):
+        if tex is None or tex.texture.type != 'IMAGE':
+            # Ignore empty texture slots or ones that aren't images
+            continue
+
+        if not mat.use_textures[tex_id]:
+            # Ignore texture slots that are disabled
+            continue
+        yield tex
+
+
+def mesh_material(mesh):
+    '''Returns the material used by a (single material) mesh from the mesh
+    list, or None if it doesn't have one'''
+    data = mesh[2][0].data
+    if not hasattr(data, 'materials') or not data.materials:
+        return None
+
+    mat_id = 0
+    for face in mesh[1].faces:
+        mat_id = face.material_index
+        break
+    return data.materials[mat_id]
+
+
+ATLAS_CHANNELS = (
+    ('diffuseMap', 'use_map_color_diffuse'),
+    ('specularMap', 'use_map_color_spec'),
+    ('emissiveMap', 'use_map_emission'),
+)
+
+
+class TextureAtlas(object):
+    '''Packs the images of materials that only differ by their textures into
+    shared atlas pages. The texCoords of the meshes using those materials are
+    remapped into atlas space and each page is exported as a single material.
+
+    Packed pages are cached in ATLAS_CACHE_DIR keyed by the contents of the
+    input images, so re-exporting an unchanged scene doesn't re-pack them.
+
+    remap is a dict of {'material_name': 'atlas_material_name', ...}
+    '''
+    def __init__(self, name, mesh_list, mesh_data_list, uv_list, path_data):
+        self.name = name
+        self.uv_list = uv_list
+        self.path_data = path_data
+        self.remap = dict()
+        self.page_count = 0
+
+        # Find which meshes use each material
+        materials = dict()
+        users = dict()
+        for mesh_id, mesh in enumerate(mesh_list):
+            mat = mesh_material(mesh)
+            if mat is not None:
+                materials[mat.name] = mat
+                users.setdefault(mat.name, []).append(mesh_data_list[mesh_id])
+
+        # Group the materials that can share an atlas
+        groups = dict()
+        for mat_name in sorted(materials):
+            entry = self._parse_material(materials[mat_name])
+            if entry is None:
+                continue
+            entry['users'] = users[mat_name]
+            if not all(uvs_in_unit_range(m, entry['uv']) for m in entry['users']):
+                # Tiled textures would wrap into their neighbours
+                self._skip(mat_name, "it's UVs are missing or go outside 0-1")
+                continue
+            groups.setdefault(entry['group'], []).append(entry)
+
+        make_directories([ATLAS_CACHE_DIR])
+        for group in sorted(groups):
+            self._build_group(groups[group])
+
+    def _parse_material(self, mat):
+        '''Returns a dict describing how the material could be atlased, or
+        None if it can't be'''
+        images = dict()
+        uv_layers = set()
+        for tex in image_texture_slots(mat):
+            if tex.use_map_alpha or tex.use_map_normal:
+                return self._skip(mat.name, "it has an alpha or normal map")
+            if tex.uv_layer != '' and tex.uv_layer not in self.uv_list:
+                return self._skip(mat.name, "it's UV map doesn't exist")
+            if tuple(tex.offset) != (0, 0, 0) or tuple(tex.scale) != (1, 1, 1):
+                return self._skip(mat.name, "a texture is offset or scaled")
+            if tex.uv_layer != '':
+                uv_layers.add(self.uv_list.index(tex.uv_layer))
+            else:
+                # Same as MaterialExporter, unspecified UVs use the first map
+                uv_layers.add(0)
+            for channel, flag in ATLAS_CHANNELS:
+                if getattr(tex, flag):
+                    images[channel] = tex.texture.image
+
+        if not images:
+            # Nothing to atlas
+            return None
+        if len(uv_layers) != 1:
+            return self._skip(mat.name, "it's textures use different UV maps")
+
+        channels = tuple(c for c, _flag in ATLAS_CHANNELS if c in images)
+        image_list = [images[c] for c in channels]
+        if not all(os.path.isfile(image_file_path(i)) for i in image_list):
+            return self._skip(mat.name, "an image isn't saved to disk")
+        if any(i.is_dirty for i in image_list):
+            # Atlases are drawn from (and cached by) the files on disk
+            return self._skip(mat.name, "an image has unsaved changes")
+        sizes = set(tuple(image.size) for image in image_list)
+        if len(sizes) != 1:
+            # Every channel has to use the same rectangle
+            return self._skip(mat.name, "it's images are different sizes")
+        size = sizes.pop()
+        if max(align(s + 2 * ATLAS_PADDING) for s in size) > ATLAS_SIZE or \
+                min(size) == 0:
+            return self._skip(mat.name, "an image is too big for a page")
+
+        uv_layer = uv_layers.pop()
+        properties = json.dumps(parse_basic_properties(mat), sort_keys=True)
+        return {
+            'material': mat,
+            'channels': channels,
+            'images': tuple(i.name for i in image_list),
+            'image_list': image_list,
+            'size': size,
+            'uv': uv_layer,
+            'group': (channels, uv_layer, properties),
+        }
+
+    def _skip(self, mat_name, reason):
+        '''Tells the user that a material isn't being atlased and why'''
+        warn("Not atlasing material {} because {}".format(mat_name, reason))
+
+    def _build_group(self, entries):
+        '''Packs a group of compatible materials into atlas pages'''
+        sources = dict()  # Materials using the same images share a rectangle
+        for entry in entries:
+            sources.setdefault(entry['images'], []).append(entry)
+        if len(sources) < 2:
+            # Nothing to be gained
+            return
+
+        source_list = [sources[k] for k in sorted(sources)]
+        channels = entries[0]['channels']
+        uv_layer = entries[0]['uv']
+
+        cache_key = self._cache_key(channels, source_list)
+        layout = self._load_layout(cache_key, channels)
+        if layout is None:
+            info("Packing {} images into an atlas".format(len(source_list)))
+            layout = pack_rectangles([s[0]['size'] for s in source_list])
+            self._render(cache_key, channels, layout, source_list)
+            layout_path = os.path.join(ATLAS_CACHE_DIR, cache_key + '.json')
+            json.dump(layout, open(layout_path, 'w'), **JSON_PARAMS)
+
+        for page_id, page in enumerate(layout['pages']):
+            mat_name = '{}.atlas{}'.format(self.name, self.page_count)
+            self.page_count += 1
+            self._export_page(
+                cache_key, page_id, mat_name, channels, uv_layer,
+                entries[0]['material']
+            )
+
+            page_width, page_height = page['size']
+            for src_id, x_pos, y_pos, width, height in page['rects']:
+                for entry in source_list[src_id]:
+                    self.remap[entry['material'].name] = mat_name
+                    for mesh_data in entry['users']:
+                        uv_data = mesh_data.vert_data[
+                            'texCoord{}'.format(uv_layer)
+                        ]['data']
+                        for i in range(0, len(uv_data), 2):
+                            uv_data[i] = \
+                                (x_pos + uv_data[i] * width) / page_width
+                            uv_data[i+1] = \
+                                (y_pos + uv_data[i+1] * height) / page_height
+
+    def _cache_key(self, channels, source_list):
+        '''Hashes the input images and packing settings'''
+        sha = hashlib.sha1()
+        sha.update(json.dumps(
+            [ATLAS_SIZE, ATLAS_PADDING, ATLAS_ALIGN, channels]
+        ).encode('utf-8'))
+        for source in source_list:
+            for image in source[0]['image_list']:
+                sha.update(hash_file(image_file_path(image)).encode('utf-8'))
+        return sha.hexdigest()
+
+    def _load_layout(self, cache_key, channels):
+        '''Returns the cached layout for these images, or None if the cache
+        doesn't have all of it'''
+        layout_path = os.path.join(ATLAS_CACHE_DIR, cache_key + '.json')
+        if not os.path.isfile(layout_path):
+            return None
+        layout = json.load(open(layout_path))
+        for page_id in range(len(layout['pages'])):
+            for channel in channels:
+                if not os.path.isfile(cache_image_path(
+                        cache_key, channel, page_id)):
+                    return None
+        return layout
+
+    def _render(self, cache_key, channels, layout, source_list):
+        '''Draws the atlas pages into the cache'''
+        for page_id, page in enumerate(layout['pages']):
+            page_width, page_height = page['size']
+            for channel_id, channel in enumerate(channels):
+                pixels = array.array('f', [0.0]) * (
+                    page_width * page_height * 4
+                )
+                for src_id, x_pos, y_pos, width, height in page['rects']:
+                    image = source_list[src_id][0]['image_list'][channel_id]
+                    blit_with_gutter(
+                        pixels, page_width,
+                        image_pixels(image_file_path(image)),
+                        x_pos, y_pos, width, height
+                    )
+                save_png(
+                    cache_image_path(cache_key, channel, page_id),
+                    pixels, page_width, page_height
+                )
+
+    def _export_page(self, cache_key, page_id, mat_name, channels, uv_layer,
+                     material):
+        '''Copies an atlas page out of the cache and exports it's material'''
+        path_to_image_dir = os.path.relpath(
+            self.path_data['img'], self.path_data['mat']
+        )
+        output = {'mapping_format': 'path', 'name': mat_name}
+        output.update(parse_basic_properties(material))
+        for channel in channels:
+            image_name = '{}.{}.png'.format(mat_name, channel)
+            shutil.copy2(
+                cache_image_path(cache_key, channel, page_id),
+                os.path.join(self.path_data['img'], image_name)
+            )
+            output[channel] = os.path.join(path_to_image_dir, image_name)
+            output[channel + 'Uv'] = uv_layer
+
+        file_path = os.path.join(self.path_data['mat'], mat_name + '.json')
+        json.dump(output, open(file_path, 'w'), **JSON_PARAMS)
+
+
+class SkylinePacker(object):
+    '''Bottom-left skyline bin packer for a single atlas page'''
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.used_width = 0
+        self.used_height = 0
+        # Segments of the skyline in the form [x, y, width]
+        self.skyline = [[0, 0, width]]
+
+    def insert(self, width, height):
+        '''Places a rectangle as low (then as far left) as possible, returning
+        it's position or None if it doesn't fit on this page'''
+        best = None
+        for index in range(len(self.skyline)):
+            y_pos = self._fit(index, width, height)
+            if y_pos is None:
+                continue
+            x_pos = self.skyline[index][0]
+            if best is None or (y_pos, x_pos) < (best[1], best[0]):
+                best = (x_pos, y_pos, index)
+
+        if best is None:
+            return None
+
+        x_pos, y_pos, index = best
+        self._add_segment(index, x_pos, y_pos + height, width)
+        self.used_width = max(self.used_width, x_pos + width)
+        self.used_height = max(self.used_height, y_pos + height)
+        return x_pos, y_pos
+
+    def _fit(self, index, width, height):
+        '''Returns the height a rectangle would sit at if it's left edge was
+        at the start of a segment, or None if it doesn't fit there'''
+        if self.skyline[index][0] + width > self.width:
+            return None
+        y_pos = 0
+        remaining = width
+        while remaining > 0:
+            y_pos = max(y_pos, self.skyline[index][1])
+            if y_pos + height > self.height:
+                return None
+            remaining -= self.skyline[index][2]
+            index += 1
+        return y_pos
+
+    def _add_segment(self, index, x_pos, y_pos, width):
+        '''Raises the skyline where a rectangle has been placed'''
+        self.skyline.insert(index, [x_pos, y_pos, width])
+
+        # Shrink or remove the segments underneath the new one
+        index += 1
+        while index < len(self.skyline):
+            previous = self.skyline[index - 1]
+            segment = self.skyline[index]
+            overlap = previous[0] + previous[2] - segment[0]
+            if overlap <= 0:
+                break
+            segment[0] += overlap
+            segment[2] -= overlap
+            if segment[2] > 0:
+                break
+            del self.skyline[index]
+
+        # Merge neighbouring segments of the same height
+        index = 0
+        while index < len(self.skyline) - 1:
+            if self.skyline[index][1] == self.skyline[index + 1][1]:
+                self.skyline[index][2] += self.skyline[index + 1][2]
+                del self.skyline[index + 1]
+            else:
+                index += 1
+
+
+def pack_rectangles(sizes):
+    '''Packs images of the given sizes into as few atlas pages as it can.
+    Returns a layout in the form:
+        {'pages': [{'size': [w, h], 'rects': [[src_id, x, y, w, h], ...]}]}
+    Where x and y are the position of the image itself, inside it's gutter'''
+    order = sorted(
+        range(len(sizes)), key=lambda i: (-sizes[i][1], -sizes[i][0], i)
+    )
+
+    pages = list()
+    packers = list()
+    for src_id in order:
+        width, height = sizes[src_id]
+        cell_width = align(width + 2 * ATLAS_PADDING)
+        cell_height = align(height + 2 * ATLAS_PADDING)
+
+        position = None
+        for page, packer in zip(pages, packers):
+            position = packer.insert(cell_width, cell_height)
+            if position is not None:
+                break
+        if position is None:
+            page = {'size': None, 'rects': list()}
+            packer = SkylinePacker(ATLAS_SIZE, ATLAS_SIZE)
+            pages.append(page)
+            packers.append(packer)
+            position = packer.insert(cell_width, cell_height)
+
+        page['rects'].append([
+            src_id,
+            position[0] + ATLAS_PADDING,
+            position[1] + ATLAS_PADDING,
+            width,
+            height
+        ])
+
+    # Trim the pages down to the smallest power of two that holds everything
+    for page, packer in zip(pages, packers):
+        page['size'] = [
+            next_power_of_two(packer.used_width),
+            next_power_of_two(packer.used_height)
+        ]
+    return {'pages': pages}
+
+
+def blit_with_gutter(pixels, page_width, source, x_pos, y_pos, width, height):
+    '''Copies an image's RGBA pixels into an atlas page, filling the gutter
+    around it with the image's edge pixels so that filtering and the first
+    ATLAS_MIP_LEVELS mip levels don't pick up it's neighbours'''
+    cell_width = align(width + 2 * ATLAS_PADDING)
+    cell_height = align(height + 2 * ATLAS_PADDING)
+    right_gutter = cell_width - ATLAS_PADDING - width
+    row_length = width * 4
+
+    for cell_row in range(cell_height):
+        src_row = min(max(cell_row - ATLAS_PADDING, 0), height - 1)
+        src = source[src_row * row_length:(src_row + 1) * row_length]
+        row = src[:4] * ATLAS_PADDING + src + src[-4:] * right_gutter
+        start = (y_pos - ATLAS_PADDING + cell_row) * page_width
+        start = (start + x_pos - ATLAS_PADDING) * 4
+        pixels[start:start + len(row)] = row
+
+
+def image_pixels(file_path):
+    '''Returns the pixels of an image file as a flat array of RGBA floats,
+    bottom row first. The file is loaded fresh so that the pixels always match
+    the file that copy_image would ship and that the atlas cache is keyed by'''
+    image = bpy.data.images.load(file_path)
+    width, height = image.size
+    channels = image.channels
+    if hasattr(image.pixels, 'foreach_get'):
+        flat = array.array('f', [0.0]) * (width * height * channels)
+        image.pixels.foreach_get(flat)
+    else:
+        # Older blenders can only copy the pixels out as a tuple
+        flat = array.array('f', image.pixels[:])
+    bpy.data.images.remove(image)
+
+    if channels == 4:
+        return flat
+
+    rgba = array.array('f', [1.0]) * (width * height * 4)
+    for channel in range(3):
+        if channels >= 3:
+            rgba[channel::4] = flat[channel::channels]
+        else:
+            # Greyscale, possibly with alpha
+            rgba[channel::4] = flat[0::channels]
+    if channels == 2:
+        rgba[3::4] = flat[1::channels]
+    return rgba
+
+
+def save_png(file_path, pixels, width, height):
+    '''Writes an array of RGBA floats out to a png file'''
+    image = bpy.data.images.new("TmpAtlas", width, height, alpha=True)
+    if hasattr(image.pixels, 'foreach_set'):
+        image.pixels.foreach_set(pixels)
+    else:
+        image.pixels = pixels
+    image.filepath_raw = file_path
+    image.file_format = 'PNG'
+    image.save()
+    bpy.data.images.remove(image)
+
+
+def uvs_in_unit_range(mesh_data, uv_layer):
+    '''Checks that a mesh's UVs don't wrap, so it can be moved into an atlas'''
+    uv_data = mesh_data.vert_data.get('texCoord{}'.format(uv_layer))
+    if uv_data is None:
+        return False
+    return all(-1e-4 <= uv <= 1 + 1e-4 for uv in uv_data['data'])
+
+
+def cache_image_path(cache_key, channel, page_id):
+    '''Where an atlas page is stored in the cache'''
+    return os.path.join(
+        ATLAS_CACHE_DIR, '{}.{}.{}.png'.format(cache_key, channel, page_id)
+    )
+
+
+def image_file_path(image):
+    '''The absolute path of the file an image was loaded from'''
+    return bpy.path.abspath(image.filepath)
+
+
+def hash_file(file_path):
+    '''Returns the sha1 of a files contents'''
+    sha = hashlib.sha1()
+    with open(file_path, 'rb') as file_obj:
+        for block in iter(lambda: file_obj.read(65536), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def align(value):
+    '''Rounds a pixel size up to a multiple of ATLAS_ALIGN'''
+    return -(-value // ATLAS_ALIGN) * ATLAS_ALIGN
+
+
+def next_power_of_two(value):
+    '''The smallest power of two that is at least value'''
+    power = 1
+    while power < value:
+        power *= 2
+    return power
+
+
 def warn(message):
     '''Display a warning message'''
     print("\nWarning: {}".format(message))
 
 
+def report(message):
+    '''Display a message that should stay on screen'''
+    print("\nReport: {}".format(message))
+
+
 def info(message):
     '''Displays an info message'''
     print("\rInfo: {}".format(message), end='\r')